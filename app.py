@@ -1,33 +1,93 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, UploadFile, File
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-import base64
+import asyncio
+import binascii
+from contextlib import asynccontextmanager
 import io
 import os
+import re
 import subprocess
 import tempfile
-from PIL import Image
-from typing import Optional
+from PIL import Image, features
+from typing import List, Optional, Tuple, Union
 import logging
 
-logging.basicConfig(level=logging.INFO)
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+# getLevelName() maps known level names to their number, anything else to a string
+valid_log_level = isinstance(logging.getLevelName(log_level), int)
+logging.basicConfig(level=log_level if valid_log_level else logging.INFO)
 logger = logging.getLogger(__name__)
+if not valid_log_level:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", log_level)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    upscaler = UpscalerService()
+    await upscaler.start()
+    app.state.upscaler = upscaler
+    yield
+    await upscaler.stop()
 
 app = FastAPI(
     title="AI Image Upscaler",
     description="Lightweight AI image upscaling service with Real-ESRGAN-ncnn-vulkan",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# format name -> (Pillow format, media type, file extension, save options)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png", "png", {"compress_level": 1}),
+    "webp": ("WEBP", "image/webp", "webp", {"quality": 90, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", {"quality": 92, "progressive": False, "optimize": False}),
+}
+WEBP_MAX_SIZE = 16383
+# Pillow built without libwebp (e.g. a local Pillow-SIMD build missing the
+# headers) cannot encode WEBP at all
+WEBP_AVAILABLE = features.check('webp')
+if not WEBP_AVAILABLE:
+    logger.warning("Pillow has no WEBP support, WEBP output will be encoded as PNG")
+STREAM_CHUNK_SIZE = 1024 * 1024
+RETRY_AFTER_SECONDS = 5
+
+class UpscalerBusyError(Exception):
+    pass
+
 class Base64Request(BaseModel):
     image: str
     scale: Optional[int] = 4
+    format: Optional[str] = "webp"
 
 class UpscalerService:
     def __init__(self):
         self.realesrgan_binary = "/app/realesrgan-ncnn-vulkan"
         self.models_path = "/app/models"
-        self.temp_dir = "/tmp"
+        # /dev/shm avoids disk I/O but is only 64MB in Docker by default, so
+        # it has to be opted into with TEMP_DIR
+        self.temp_dir = os.getenv("TEMP_DIR", tempfile.gettempdir())
+        self.batch_size = int(os.getenv("BATCH_SIZE", "4"))
+        self.batch_max_wait_ms = int(os.getenv("BATCH_MAX_WAIT_MS", "20"))
+        self._queue = None
+        self.workers = int(os.getenv("NCNN_WORKERS", "1"))
+        # Without a consumer every queued job would wait forever
+        if self.workers < 1:
+            raise ValueError(f"NCNN_WORKERS must be at least 1, got {self.workers}")
+        self.max_queued_jobs = int(os.getenv("MAX_QUEUED_JOBS", "32"))
+        # asyncio.Queue(maxsize=0) is unbounded, which would disable admission control
+        if self.max_queued_jobs < 1:
+            raise ValueError(f"MAX_QUEUED_JOBS must be at least 1, got {self.max_queued_jobs}")
+        self.threads = os.getenv("NCNN_THREADS")
+        # A bad -j value makes every run fail and all traffic fall back to
+        # LANCZOS, so reject it at startup
+        if self.threads and not re.fullmatch(r"\d+:\d+:\d+", self.threads):
+            raise ValueError(f"NCNN_THREADS must look like load:proc:save (e.g. 1:2:2), got {self.threads!r}")
+        self.tile_size = int(os.getenv("NCNN_TILE_SIZE", "0"))
+        if self.tile_size != 0 and self.tile_size < 32:
+            raise ValueError(f"NCNN_TILE_SIZE must be 0 (auto) or at least 32, got {self.tile_size}")
+        self._consumer_tasks = []
+        self._warmup_task = None
+        self.ready = False
         self._check_binary()
     
     def _check_binary(self):
@@ -37,50 +97,169 @@ class UpscalerService:
         else:
             logger.info("Real-ESRGAN-ncnn-vulkan binary found")
     
-    def upscale_image(self, image: Image.Image, scale: int = 4) -> Image.Image:
+    async def start(self):
+        # A fixed pool of consumers bounds how many binary processes run at
+        # once; extra requests wait in the queue instead of spawning more
+        self._queue = asyncio.Queue(maxsize=self.max_queued_jobs)
+        self._consumer_tasks = [
+            asyncio.create_task(self._consume_batches()) for _ in range(self.workers)
+        ]
+        # Warm up in the background so the server can bind meanwhile; /ready
+        # reports 503 until it is done
+        self._warmup_task = asyncio.create_task(self._warmup())
+    
+    async def stop(self):
+        self.ready = False
+        tasks = self._consumer_tasks + [self._warmup_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._consumer_tasks = []
+        self._warmup_task = None
+    
+    async def _warmup(self):
+        # The first run of each model pays for shader compilation and for
+        # reading the binary and weights from disk; do it before real traffic.
+        # Jobs go through the queue so warm-up respects the NCNN_WORKERS cap
+        if self.realesrgan_binary:
+            image = Image.new('RGB', (256, 256))
+            for scale in (2, 4):
+                try:
+                    await self._upscale_ncnn(image, scale)
+                except Exception as e:
+                    logger.warning("Real-ESRGAN-ncnn warm-up failed for scale %d: %s", scale, e)
+            logger.info("Real-ESRGAN-ncnn warm-up finished")
+        self.ready = True
+    
+    async def upscale_image(self, image: Image.Image, scale: int = 4) -> Image.Image:
         try:
             if self.realesrgan_binary:
-                return self._upscale_ncnn(image, scale)
+                return await self._upscale_ncnn(image, scale)
             else:
-                return self._upscale_fallback(image, scale)
+                return await asyncio.to_thread(self._upscale_fallback, image, scale)
+        except UpscalerBusyError:
+            raise
         except Exception as e:
             logger.error(f"Real-ESRGAN-ncnn upscaling failed: {e}")
-            logger.info("Falling back to simple upscaling")
-            return self._upscale_fallback(image, scale)
+            logger.debug("Falling back to simple upscaling")
+            return await asyncio.to_thread(self._upscale_fallback, image, scale)
     
-    def _upscale_ncnn(self, image: Image.Image, scale: int) -> Image.Image:
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as input_file:
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as output_file:
+    async def _upscale_ncnn(self, image: Image.Image, scale: int) -> Image.Image:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((image, scale, future))
+        except asyncio.QueueFull:
+            raise UpscalerBusyError(f"{self.max_queued_jobs} jobs already queued")
+        return await future
+    
+    async def _consume_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_max_wait_ms / 1000
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Each binary invocation runs a single model/scale, so group by scale
+            groups = {}
+            for job in batch:
+                groups.setdefault(job[1], []).append(job)
+            
+            for scale, jobs in groups.items():
+                logger.debug("Running ncnn batch of %d image(s) at scale %d", len(jobs), scale)
                 try:
-                    image.save(input_file.name, 'PNG')
-                    
-                    model_name = self._get_model_name(scale)
-                    
-                    cmd = [
-                        self.realesrgan_binary,
-                        "-i", input_file.name,
-                        "-o", output_file.name,
-                        "-n", model_name,
-                        "-s", str(scale),
-                        "-f", "png"
-                    ]
-                    
-                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-                    
-                    if result.returncode != 0:
-                        logger.error(f"Real-ESRGAN-ncnn failed: {result.stderr}")
-                        raise Exception("NCNN processing failed")
-                    
-                    if os.path.exists(output_file.name):
-                        upscaled_image = Image.open(output_file.name)
-                        return upscaled_image.copy()
-                    else:
-                        raise Exception("Output file not created")
-                        
-                finally:
-                    for temp_file in [input_file.name, output_file.name]:
-                        if os.path.exists(temp_file):
-                            os.unlink(temp_file)
+                    results = await asyncio.to_thread(
+                        self._run_ncnn_batch, [image for image, _, _ in jobs], scale
+                    )
+                except Exception as e:
+                    for _, _, future in jobs:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, _, future), result in zip(jobs, results):
+                        if future.done():
+                            continue
+                        if isinstance(result, Exception):
+                            future.set_exception(result)
+                        else:
+                            future.set_result(result)
+    
+    def _run_ncnn_batch(
+        self, images: List[Image.Image], scale: int
+    ) -> List[Union[Image.Image, Exception]]:
+        # The binary accepts a directory as input, so a whole batch shares a
+        # single process start and model load
+        with tempfile.TemporaryDirectory(dir=self.temp_dir) as work_dir:
+            input_dir = os.path.join(work_dir, "in")
+            output_dir = os.path.join(work_dir, "out")
+            os.mkdir(input_dir)
+            os.mkdir(output_dir)
+            
+            # One bad input must not fail the rest of the batch, on either side
+            # of the binary run
+            input_errors = {}
+            for i, image in enumerate(images):
+                input_path = os.path.join(input_dir, f"{i}.png")
+                try:
+                    image.save(input_path, 'PNG', compress_level=1)
+                except Exception as e:
+                    input_errors[i] = e
+                    if os.path.exists(input_path):
+                        os.unlink(input_path)
+            
+            if len(input_errors) == len(images):
+                return [input_errors[i] for i in range(len(images))]
+            
+            model_name = self._get_model_name(scale)
+            
+            cmd = [
+                self.realesrgan_binary,
+                "-i", input_dir,
+                "-o", output_dir,
+                "-n", model_name,
+                "-s", str(scale),
+                "-f", "png"
+            ]
+            if self.threads:
+                cmd += ["-j", self.threads]
+            if self.tile_size:
+                cmd += ["-t", str(self.tile_size)]
+            
+            error = Exception("Output file not created")
+            try:
+                result = subprocess.run(cmd, capture_output=True, text=True, timeout=60 * len(images))
+                if result.returncode != 0:
+                    logger.error(f"Real-ESRGAN-ncnn failed: {result.stderr}")
+                    error = Exception("NCNN processing failed")
+            except subprocess.TimeoutExpired:
+                logger.error("Real-ESRGAN-ncnn timed out on a batch of %d", len(images))
+                error = Exception("NCNN processing timed out")
+            
+            # Every image is resolved from its own output file
+            upscaled_images = []
+            for i in range(len(images)):
+                if i in input_errors:
+                    upscaled_images.append(input_errors[i])
+                    continue
+                output_path = os.path.join(output_dir, f"{i}.png")
+                if not os.path.exists(output_path):
+                    upscaled_images.append(error)
+                    continue
+                try:
+                    # load() reads the pixels and closes the file, no copy needed
+                    upscaled_image = Image.open(output_path)
+                    upscaled_image.load()
+                except Exception as e:
+                    upscaled_images.append(e)
+                else:
+                    upscaled_images.append(upscaled_image)
+            return upscaled_images
     
     def _get_model_name(self, scale: int) -> str:
         model_map = {
@@ -95,26 +274,66 @@ class UpscalerService:
         new_size = (width * scale, height * scale)
         return image.resize(new_size, Image.LANCZOS)
 
-upscaler = UpscalerService()
+def get_upscaler(request: Request) -> UpscalerService:
+    return request.app.state.upscaler
 
-def process_image(image_data: bytes, scale: int = 4) -> bytes:
+def load_image(image_data: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(image_data))
+    
+    max_size = 2048
+    new_size = None
+    if max(image.size) > max_size:
+        ratio = max_size / max(image.size)
+        new_size = tuple(int(dim * ratio) for dim in image.size)
+        # JPEGs can be decoded directly at a reduced scale
+        image.draft('RGB', new_size)
+    
+    # Without the conversion nothing forces a decode; do it here so corrupt
+    # uploads fail in this request's thread, not later in a shared batch
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    if new_size and image.size != new_size:
+        # Box-reduce first so LANCZOS only runs over the last 3x of the shrink
+        image = image.resize(new_size, Image.LANCZOS, reducing_gap=3.0)
+    
+    return image
+
+def encode_image(image: Image.Image, output_format: str = "webp") -> Tuple[io.BytesIO, str]:
+    if output_format == "webp" and not WEBP_AVAILABLE:
+        output_format = "png"
+    elif output_format == "webp" and max(image.size) > WEBP_MAX_SIZE:
+        logger.debug("%s exceeds the WEBP size limit, encoding as PNG", image.size)
+        output_format = "png"
+    
+    pil_format, _, _, save_options = OUTPUT_FORMATS[output_format]
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format=pil_format, **save_options)
+    output_buffer.seek(0)
+    
+    return output_buffer, output_format
+
+def iter_buffer(buffer: io.BytesIO):
+    while chunk := buffer.read(STREAM_CHUNK_SIZE):
+        yield chunk
+
+async def process_image(
+    upscaler: UpscalerService, image_data: bytes, scale: int = 4, output_format: str = "webp"
+) -> Tuple[io.BytesIO, str]:
+    # Decoding, resizing and encoding are CPU-bound, keep them off the event loop
     try:
-        image = Image.open(io.BytesIO(image_data)).convert('RGB')
-        
-        max_size = 2048
-        if max(image.size) > max_size:
-            ratio = max_size / max(image.size)
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            image = image.resize(new_size, Image.LANCZOS)
-        
-        upscaled = upscaler.upscale_image(image, scale)
-        
-        output_buffer = io.BytesIO()
-        upscaled.save(output_buffer, format='PNG', optimize=True)
-        output_buffer.seek(0)
-        
-        return output_buffer.getvalue()
+        image = await asyncio.to_thread(load_image, image_data)
+        upscaled = await upscaler.upscale_image(image, scale)
+        return await asyncio.to_thread(encode_image, upscaled, output_format)
         
+    except UpscalerBusyError as e:
+        logger.debug("Rejecting request, upscaler is busy: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="Upscaler is busy, retry later",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
     except Exception as e:
         logger.error(f"Image processing failed: {e}")
         raise HTTPException(status_code=400, detail=f"Image processing failed: {str(e)}")
@@ -124,44 +343,66 @@ async def root():
     return {"message": "AI Image Upscaler API", "version": "1.0.0"}
 
 @app.get("/health")
-async def health():
+async def health(upscaler: UpscalerService = Depends(get_upscaler)):
     return {
         "status": "healthy", 
         "engine": "Real-ESRGAN-ncnn-vulkan" if upscaler.realesrgan_binary else "Fallback",
         "binary_found": upscaler.realesrgan_binary is not None
     }
 
+@app.get("/ready")
+async def ready(upscaler: UpscalerService = Depends(get_upscaler)):
+    if not upscaler.ready:
+        raise HTTPException(status_code=503, detail="Upscaler is not ready")
+    return {"status": "ready"}
+
 @app.post("/upscale/binary")
-async def upscale_binary(file: UploadFile = File(...), scale: int = 4):
+async def upscale_binary(
+    file: UploadFile = File(...),
+    scale: int = 4,
+    format: str = "webp",
+    upscaler: UpscalerService = Depends(get_upscaler)
+):
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
     if scale not in [2, 4, 8]:
         raise HTTPException(status_code=400, detail="Scale must be 2, 4, or 8")
     
+    if format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be png, webp, or jpeg")
+    
     image_data = await file.read()
-    upscaled_data = process_image(image_data, scale)
+    upscaled_buffer, output_format = await process_image(upscaler, image_data, scale, format)
+    _, media_type, extension, _ = OUTPUT_FORMATS[output_format]
+    filename = f"upscaled_{os.path.splitext(file.filename)[0]}.{extension}"
     
     return StreamingResponse(
-        io.BytesIO(upscaled_data),
-        media_type="image/png",
-        headers={"Content-Disposition": f"attachment; filename=upscaled_{file.filename}"}
+        iter_buffer(upscaled_buffer),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
-@app.post("/upscale/base64")
-async def upscale_base64(request: Base64Request):
+@app.post("/upscale/base64", response_class=ORJSONResponse)
+async def upscale_base64(request: Base64Request, upscaler: UpscalerService = Depends(get_upscaler)):
     if request.scale not in [2, 4, 8]:
         raise HTTPException(status_code=400, detail="Scale must be 2, 4, or 8")
     
+    if request.format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be png, webp, or jpeg")
+    
     try:
-        image_data = base64.b64decode(request.image)
+        # a2b_base64 reads the ASCII str in place, b64decode would encode a copy first
+        image_data = binascii.a2b_base64(request.image)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid base64 image data")
     
-    upscaled_data = process_image(image_data, request.scale)
-    upscaled_base64 = base64.b64encode(upscaled_data).decode('utf-8')
+    upscaled_buffer, output_format = await process_image(upscaler, image_data, request.scale, request.format)
+    with upscaled_buffer.getbuffer() as upscaled_data:
+        upscaled_base64 = binascii.b2a_base64(upscaled_data, newline=False).decode('ascii')
     
-    return {"upscaled_image": upscaled_base64}
+    # Returning the response directly skips FastAPI's jsonable_encoder pass
+    return ORJSONResponse({"upscaled_image": upscaled_base64, "format": output_format})
 
 if __name__ == "__main__":
     import uvicorn